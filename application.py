@@ -2,16 +2,28 @@
 # ───────────────────────────────────────────────────────────────────
 # Structure Homes AI — Landing + Auth + Simple APIs (no TensorFlow)
 # ───────────────────────────────────────────────────────────────────
-import os, json, sqlite3
-from contextlib import closing
+import os, io, json, sqlite3, queue, hashlib, hmac, shutil, threading
 from functools import wraps
 
+try:
+    # under gunicorn -k gevent, CPU-heavy KDF calls would stall every greenlet
+    import gevent.monkey
+    from gevent import get_hub
+    _GEVENT = gevent.monkey.is_module_patched("socket")
+except ImportError:
+    _GEVENT = False
+
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHash
+from cachetools import TTLCache
+
 from flask import (
     Flask, request, jsonify, render_template, redirect,
-    url_for, session, flash, send_file, abort
+    url_for, session, flash, send_file, abort, g
 )
 from flask_cors import CORS
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import check_password_hash
+from werkzeug.utils import secure_filename
 
 # ───────────────────────────────────────────────────────────────────
 # App + CORS
@@ -20,88 +32,164 @@ app = Flask(__name__)
 app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY", "dev-secret-change-me")
 CORS(app, resources={r"/*": {"origins": "*"}})
 
+# Server-side sessions: with REDIS_URL set the cookie only carries a session
+# id and session["uid"] is a Redis GET. Without it, Flask's signed cookie.
+REDIS_URL = os.environ.get("REDIS_URL")
+if REDIS_URL:
+    import redis
+    from flask_session import Session
+    app.config.update(
+        SESSION_TYPE="redis",
+        SESSION_REDIS=redis.Redis.from_url(REDIS_URL, socket_keepalive=True),
+        SESSION_USE_SIGNER=False,
+    )
+    Session(app)
+
 ROOT_DIR       = os.path.abspath("./")
 DB_PATH        = os.path.join(ROOT_DIR, "users.db")
+DB_POOL_SIZE   = int(os.environ.get("DB_POOL_SIZE", "8"))
 
 # ───────────────────────────────────────────────────────────────────
 # DB helpers
 # ───────────────────────────────────────────────────────────────────
-def db():
-    conn = sqlite3.connect(DB_PATH)
+# Idle connections are parked here and reused across requests so the
+# file open / PRAGMA setup / page cache warm-up is paid once per conn.
+_POOL = queue.Queue(maxsize=DB_POOL_SIZE)
+
+def _connect():
+    # autocommit (isolation_level=None): every statement commits on its own
+    # statements are cached per connection by SQL text, so pooled conns skip
+    # the parse/plan step for the fixed queries below
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None,
+                           cached_statements=128)
     conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA cache_size=-20000")   # ~20 MB page cache
     return conn
 
+def _checkout():
+    try:
+        return _POOL.get_nowait()
+    except queue.Empty:
+        return _connect()
+
+def _checkin(conn):
+    try:
+        _POOL.put_nowait(conn)
+    except queue.Full:
+        conn.close()
+
+def db():
+    """Pooled connection bound to the current app context (g.db)."""
+    if "db" not in g:
+        g.db = _checkout()
+    return g.db
+
+@app.teardown_appcontext
+def release_db(exc):
+    conn = g.pop("db", None)
+    if conn is not None:
+        _checkin(conn)
+
+USER_COLUMNS       = "id, username, password_hash, tokens_remaining, is_admin"
+SQL_USER_BY_NAME   = f"SELECT {USER_COLUMNS} FROM users WHERE username=?"
+SQL_USER_BY_ID     = f"SELECT {USER_COLUMNS} FROM users WHERE id=?"
+SQL_USER_ID        = "SELECT id FROM users WHERE username=?"
+
 def init_db():
-    with closing(db()) as con:
-        con.execute("""
-        CREATE TABLE IF NOT EXISTS users(
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE NOT NULL,
-            password_hash TEXT NOT NULL,
-            tokens_remaining INTEGER NOT NULL DEFAULT 20,
-            is_admin INTEGER NOT NULL DEFAULT 0
+    con = db()
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS users(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT UNIQUE NOT NULL,
+        password_hash TEXT NOT NULL,
+        tokens_remaining INTEGER NOT NULL DEFAULT 20,
+        is_admin INTEGER NOT NULL DEFAULT 0
+    )
+    """)
+
+    # Seed demo user if missing
+    cur = con.execute(SQL_USER_ID, ("griffin",))
+    if cur.fetchone() is None:
+        con.execute(
+            "INSERT INTO users(username, password_hash, tokens_remaining, is_admin) VALUES(?,?,?,?)",
+            ("griffin", hash_password("griffin@123"), 20, 0)
         )
-        """)
-        con.commit()
-
-        # Seed demo user if missing
-        cur = con.execute("SELECT id FROM users WHERE username=?", ("griffin",))
-        if cur.fetchone() is None:
-            con.execute(
-                "INSERT INTO users(username, password_hash, tokens_remaining, is_admin) VALUES(?,?,?,?)",
-                ("griffin", generate_password_hash("griffin@123"), 20, 0)
-            )
-            con.commit()
 
-        # Ensure requested accounts
-        seed_or_update_user("griffin", "griffin@123", tokens=20,    is_admin=False)
-        seed_or_update_user("admin",   "admin@123",   tokens=10000, is_admin=True)
-        seed_or_update_user("YCdemo",  "YCdemo@123",  tokens=50,    is_admin=False)
+    # Ensure requested accounts
+    seed_or_update_user("griffin", "griffin@123", tokens=20,    is_admin=False)
+    seed_or_update_user("admin",   "admin@123",   tokens=10000, is_admin=True)
+    seed_or_update_user("YCdemo",  "YCdemo@123",  tokens=50,    is_admin=False)
 
 def get_user_by_username(username):
-    with closing(db()) as con:
-        cur = con.execute("SELECT * FROM users WHERE username=?", (username,))
-        return cur.fetchone()
+    cur = db().execute(SQL_USER_BY_NAME, (username,))
+    return cur.fetchone()
+
+# uid -> dict(row). inject_user runs on every render and /api/me is polled
+# by the header badge; both read through here. Writers below invalidate.
+USER_CACHE_TTL = int(os.environ.get("USER_CACHE_TTL", "30"))
+_USER_CACHE = TTLCache(maxsize=10_000, ttl=USER_CACHE_TTL)
+_user_cache_lock = threading.Lock()
 
 def get_user_by_id(uid):
-    with closing(db()) as con:
-        cur = con.execute("SELECT * FROM users WHERE id=?", (uid,))
-        return cur.fetchone()
+    with _user_cache_lock:
+        user = _USER_CACHE.get(uid)
+    if user is None:
+        row = db().execute(SQL_USER_BY_ID, (uid,)).fetchone()
+        if row is None:
+            return None
+        user = dict(row)
+        with _user_cache_lock:
+            _USER_CACHE[uid] = user
+    return dict(user)
+
+def _forget_user(uid=None, username=None):
+    if uid is None:
+        row = db().execute(SQL_USER_ID, (username,)).fetchone()
+        if row is None:
+            return
+        uid = row["id"]
+    with _user_cache_lock:
+        _USER_CACHE.pop(uid, None)
 
 def set_tokens(username, tokens):
-    with closing(db()) as con:
-        con.execute("UPDATE users SET tokens_remaining=? WHERE username=?", (tokens, username))
-        con.commit()
+    db().execute("UPDATE users SET tokens_remaining=? WHERE username=?", (tokens, username))
+    _forget_user(username=username)
+
+def set_password_hash(uid, password_hash):
+    db().execute("UPDATE users SET password_hash=? WHERE id=?", (password_hash, uid))
+    _forget_user(uid=uid)
 
-from werkzeug.security import generate_password_hash
 def seed_or_update_user(username: str, password: str, tokens: int, is_admin: bool):
     """Create or update a user by username. If password is None, keep the old password."""
-    with closing(db()) as con:
-        cur = con.execute("SELECT id FROM users WHERE username=?", (username,))
-        row = cur.fetchone()
-        if row is None:
+    con = db()
+    cur = con.execute(SQL_USER_ID, (username,))
+    row = cur.fetchone()
+    if row is None:
+        con.execute(
+            "INSERT INTO users(username, password_hash, tokens_remaining, is_admin) VALUES(?,?,?,?)",
+            (username, hash_password(password or "changeme"), int(tokens), 1 if is_admin else 0)
+        )
+    else:
+        if password:
             con.execute(
-                "INSERT INTO users(username, password_hash, tokens_remaining, is_admin) VALUES(?,?,?,?)",
-                (username, generate_password_hash(password or "changeme"), int(tokens), 1 if is_admin else 0)
+                "UPDATE users SET password_hash=?, tokens_remaining=?, is_admin=? WHERE username=?",
+                (hash_password(password), int(tokens), 1 if is_admin else 0, username)
             )
         else:
-            if password:
-                con.execute(
-                    "UPDATE users SET password_hash=?, tokens_remaining=?, is_admin=? WHERE username=?",
-                    (generate_password_hash(password), int(tokens), 1 if is_admin else 0, username)
-                )
-            else:
-                con.execute(
-                    "UPDATE users SET tokens_remaining=?, is_admin=? WHERE username=?",
-                    (int(tokens), 1 if is_admin else 0, username)
-                )
-        con.commit()
+            con.execute(
+                "UPDATE users SET tokens_remaining=?, is_admin=? WHERE username=?",
+                (int(tokens), 1 if is_admin else 0, username)
+            )
+        _forget_user(uid=row["id"])
 
 # Put a strong secret in your environment:  ADMIN_BOOTSTRAP_TOKEN=yourlongsecret
 @app.route("/_seed_defaults")
 def seed_defaults():
-    token = request.args.get("token")
-    if token != os.environ.get("ADMIN_BOOTSTRAP_TOKEN"):
+    token = request.args.get("token") or ""
+    expected = os.environ.get("ADMIN_BOOTSTRAP_TOKEN") or ""
+    if not expected or not hmac.compare_digest(token.encode(), expected.encode()):
         return ("forbidden", 403)
 
     seed_or_update_user("griffin", "griffin@123", tokens=20,    is_admin=False)
@@ -109,6 +197,55 @@ def seed_defaults():
     seed_or_update_user("YCdemo",  "YCdemo@123",  tokens=50,    is_admin=False)
     return "seeded", 200
 
+# ───────────────────────────────────────────────────────────────────
+# Password hashing (argon2; legacy Werkzeug hashes still verify)
+# ───────────────────────────────────────────────────────────────────
+_ph = PasswordHasher()
+
+# (stored hash, sha256(password)) -> True for recently verified logins.
+# Keyed on the stored hash so a password change invalidates the entry.
+VERIFY_CACHE_TTL = int(os.environ.get("VERIFY_CACHE_TTL", "300"))
+_VERIFIED = TTLCache(maxsize=1024, ttl=VERIFY_CACHE_TTL)
+_verified_lock = threading.Lock()
+
+def _offload(fn, *args):
+    """Run a KDF call on gevent's native threadpool (the C code drops the GIL)."""
+    if _GEVENT:
+        return get_hub().threadpool.apply(fn, args)
+    return fn(*args)
+
+def hash_password(password):
+    return _offload(_ph.hash, password)
+
+def _is_argon2(password_hash):
+    return password_hash.startswith("$argon2")
+
+def verify_password(password_hash, password):
+    key = (password_hash, hashlib.sha256(password.encode("utf-8")).digest())
+    with _verified_lock:
+        if key in _VERIFIED:
+            return True
+
+    if _is_argon2(password_hash):
+        try:
+            ok = _offload(_ph.verify, password_hash, password)
+        except (VerificationError, InvalidHash):
+            ok = False
+    else:
+        ok = _offload(check_password_hash, password_hash, password)
+
+    if ok:
+        with _verified_lock:
+            _VERIFIED[key] = True
+    return ok
+
+# Verified against when the username doesn't exist, so a miss costs the
+# same KDF run as a wrong password. The plaintext is random and never matches.
+_DUMMY_HASH = hash_password(os.urandom(16).hex())
+
+def password_needs_rehash(password_hash):
+    return not _is_argon2(password_hash) or _ph.check_needs_rehash(password_hash)
+
 # ───────────────────────────────────────────────────────────────────
 # Auth utilities
 # ───────────────────────────────────────────────────────────────────
@@ -135,13 +272,36 @@ EXAMPLE_FILES = {
     "ex2-floor1.png": "/home/sejain/repos/FloorPlanTo3D-API/images/ex2-floor1.png",
 }
 
+EXAMPLE_CACHE_CONTROL = "public, max-age=86400, immutable"
+
+def _example_entry(name, path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    mt = "image/png" if name.lower().endswith(".png") else "image/jpeg"
+    return path, mt, f"{st.st_mtime_ns:x}-{st.st_size:x}", st.st_mtime
+
+# name -> (path, mimetype, etag, mtime), stat'ed once at import
+_EXAMPLES = {}
+for _name, _path in EXAMPLE_FILES.items():
+    _entry = _example_entry(_name, _path)
+    if _entry:
+        _EXAMPLES[_name] = _entry
+
 @app.route("/examples/<name>")
 def get_example(name):
-    path = EXAMPLE_FILES.get(name)
-    if not path or not os.path.exists(path):
+    entry = _EXAMPLES.get(name)
+    if entry is None:
         return abort(404)
-    mt = "image/png" if name.lower().endswith(".png") else "image/jpeg"
-    return send_file(path, mimetype=mt)
+    path, mt, etag, mtime = entry
+    if etag in request.if_none_match:
+        resp = app.response_class(status=304)
+        resp.set_etag(etag)
+    else:
+        resp = send_file(path, mimetype=mt, conditional=True, etag=etag, last_modified=mtime)
+    resp.headers["Cache-Control"] = EXAMPLE_CACHE_CONTROL
+    return resp
 
 # ───────────────────────────────────────────────────────────────────
 # Pages
@@ -162,9 +322,12 @@ def login():
         username = (request.form.get("username") or "").strip()
         password = request.form.get("password") or ""
         row = get_user_by_username(username)
-        if not row or not check_password_hash(row["password_hash"], password):
+        ok = verify_password(row["password_hash"] if row else _DUMMY_HASH, password)
+        if not row or not ok:
             flash("Invalid username or password", "error")
             return render_template("login.html"), 401
+        if password_needs_rehash(row["password_hash"]):
+            set_password_hash(row["id"], hash_password(password))
         session["uid"] = row["id"]
         nxt = request.args.get("next") or url_for("demo")
         return redirect(nxt)
@@ -221,8 +384,7 @@ def admin():
             except Exception as e:
                 msg = f"Error: {e}"
 
-    with closing(db()) as con:
-        rows = con.execute("SELECT username, tokens_remaining, is_admin FROM users ORDER BY username").fetchall()
+    rows = db().execute("SELECT username, tokens_remaining, is_admin FROM users ORDER BY username").fetchall()
     return render_template("admin.html", rows=rows, message=msg)
 
 # ───────────────────────────────────────────────────────────────────
@@ -251,15 +413,51 @@ def api_submit():
 UPLOAD_DIR = os.path.join(ROOT_DIR, "uploads")
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
+# Werkzeug keeps parts up to 500 KiB in RAM (SpooledTemporaryFile); fileno()
+# would force those to disk, so they are simply copied
+_SPOOL_MAX = 500 * 1024
+
+def _stream_fd(stream):
+    """OS-level fd behind an upload stream, or None for small / in-memory parts."""
+    if isinstance(stream, io.BytesIO):
+        return None
+    try:
+        pos = stream.tell()
+        size = stream.seek(0, os.SEEK_END)
+        stream.seek(pos)
+        if size - pos <= _SPOOL_MAX:
+            return None
+        return stream.fileno()
+    except (AttributeError, OSError, ValueError):
+        return None
+
+def _save_upload(f, save_path):
+    """Write an upload to disk: kernel-side sendfile() when it already has a fd."""
+    src = f.stream
+    with open(save_path, "wb") as dst:
+        in_fd = _stream_fd(src)
+        if in_fd is not None and hasattr(os, "sendfile"):
+            offset = src.tell()
+            remaining = os.fstat(in_fd).st_size - offset
+            while remaining > 0:
+                sent = os.sendfile(dst.fileno(), in_fd, offset, remaining)
+                if not sent:
+                    break
+                offset += sent
+                remaining -= sent
+        else:
+            shutil.copyfileobj(src, dst, 1 << 20)
+
 @app.route("/api/upload", methods=["POST"])
 @login_required
 def api_upload():
     if "file" not in request.files:
         return jsonify(ok=False, error="field 'file' missing"), 400
     f = request.files["file"]
-    if not f.filename:
+    filename = secure_filename(f.filename or "")
+    if not filename:
         return jsonify(ok=False, error="empty filename"), 400
-    save_path = os.path.join(UPLOAD_DIR, f.filename)
-    f.save(save_path)
-    return jsonify(ok=True, filename=f.filename, path=save_path)
+    save_path = os.path.join(UPLOAD_DIR, filename)
+    _save_upload(f, save_path)
+    return jsonify(ok=True, filename=filename, path=save_path)
 
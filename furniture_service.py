@@ -15,15 +15,23 @@ POST /furnish/yolo    (multipart/form-data)  -> YOLO furniture detection
 200 → original JSON + {"furniture":[{x1,y1,x2,y2,type,room,confidence}]}
 """
 import os
-import os, io, re, json, base64
+import os, io, re, json, binascii, threading
 from typing import Any, Dict, List, Tuple
 
+import cv2
 import numpy as np
 from PIL import Image
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 from dotenv import load_dotenv
 
+try:
+    import orjson                       # C JSON parser/serializer, if installed
+    _json_loads = orjson.loads
+except ImportError:
+    orjson = None
+    _json_loads = json.loads
+
 # ───────────────────────────────────────────────────────────────────
 #  ENV & OpenAI client (reads OPENAI_API_KEY from env or .env)
 # ───────────────────────────────────────────────────────────────────
@@ -31,8 +39,23 @@ load_dotenv()
 if not os.getenv("OPENAI_API_KEY"):
     raise RuntimeError("OPENAI_API_KEY is not set (export it or put it in .env)")
 
-from openai import OpenAI
-oa_client = OpenAI()
+from openai import DefaultHttpxClient, OpenAI
+
+try:
+    import h2  # noqa: F401  (enables HTTP/2 in httpx)
+    _http2 = True
+except ImportError:
+    _http2 = False
+
+# One keep-alive pool shared by every request thread's GPT call, so they reuse
+# TLS connections instead of re-handshaking. The SDK's own client defaults
+# (1000 connections / 100 keep-alive) already cover the concurrent request
+# threads; only HTTP/2 and the timeout change.
+_http = DefaultHttpxClient(
+    http2=_http2,
+    timeout=float(os.getenv("OPENAI_TIMEOUT", 120)),
+)
+oa_client = OpenAI(http_client=_http)
 
 # ───────────────────────────────────────────────────────────────────
 #  Flask
@@ -40,29 +63,49 @@ oa_client = OpenAI()
 app = Flask(__name__)
 CORS(app)
 
-# add near the top with other imports
-from PIL import ImageOps, ImageFilter
+GPT_IMAGE_LIMIT = 4_000_000
+# /furnish bodies above this are refused (413) before the multipart parse;
+# /furnish/yolo stays uncapped for large floor-plan scans
+FURNISH_MAX_CONTENT_LENGTH = int(os.getenv("FURNISH_MAX_CONTENT_LENGTH", 4_500_000))
+
+# One YOLO call at a time: the Ultralytics predictor is not thread-safe
+_yolo_lock = threading.Lock()
+
+# --- simple floor-plan preprocessing (OpenCV, one LUT + one morph pass) ---
+_DILATE_KERNEL = np.ones((3, 3), np.uint8)
+_LEVELS = np.arange(256, dtype=np.float64)
+
+def _autocontrast_cut(gray: np.ndarray, cutoff: int = 2) -> Tuple[int, int]:
+    """Histogram bounds after dropping `cutoff`% at each end (PIL autocontrast)."""
+    hist = np.bincount(gray.ravel(), minlength=256)
+    cut = gray.size * cutoff // 100
+    lo = int(np.argmax(np.cumsum(hist) > cut))
+    hi = 255 - int(np.argmax(np.cumsum(hist[::-1]) > cut))
+    return lo, hi
 
-# --- NEW: simple floor-plan preprocessing (PIL-based) ---
 def fp_preprocess(np_img: np.ndarray, mode: str = "auto") -> np.ndarray:
     """
     For black/gray line drawings: boost contrast, binarize, thicken lines.
-    Returns RGB np.uint8 HxWx3. mode='none' to bypass.
+    Takes/returns BGR np.uint8 HxWx3 (Ultralytics' ndarray order). mode='none' to bypass.
     """
     if mode == "none":
         return np_img
 
-    im = Image.fromarray(np_img).convert("L")
-    im = ImageOps.autocontrast(im, cutoff=2)               # normalize contrast
-    # adaptive-ish threshold via point + autocontrast works well enough here
-    bw = im.point(lambda p: 255 if p > 200 else 0)         # binarize
-    bw = bw.filter(ImageFilter.MaxFilter(size=3))          # thicken lines (dilate)
+    gray = cv2.cvtColor(np_img, cv2.COLOR_BGR2GRAY) if np_img.ndim == 3 else np_img
+
+    # autocontrast(cutoff=2) -> threshold(>200) -> invert, folded into one LUT
+    lo, hi = _autocontrast_cut(gray, cutoff=2)
+    if hi > lo:
+        scale = 255.0 / (hi - lo)
+        stretched = np.clip((_LEVELS * scale - lo * scale).astype(np.int64), 0, 255)
+    else:
+        stretched = _LEVELS
+    lut = np.where(stretched > 200, 0, 255).astype(np.uint8)
+    inv = cv2.LUT(gray, lut)
 
-    # YOLO prefers natural-looking RGB; invert to dark-on-light if needed
-    # Try both – empirically invert=True often works better for plans:
-    inv = ImageOps.invert(bw)
-    rgb = Image.merge("RGB", (inv, inv, inv))
-    return np.array(rgb, dtype=np.uint8)
+    # thicken lines: dilating the white-on-black mask == eroding its inverse
+    inv = cv2.erode(inv, _DILATE_KERNEL)
+    return cv2.cvtColor(inv, cv2.COLOR_GRAY2BGR)
 
 
 # Common lists (for GPT instructions + normalization)
@@ -116,44 +159,84 @@ No markdown fences, no escaping.
 # ───────────────────────────────────────────────────────────────────
 #  Helpers (shared by GPT & YOLO)
 # ───────────────────────────────────────────────────────────────────
+_FENCE_RE = re.compile(r"^```[a-z]*\n?", re.I)
+
 def clean_and_load(raw: str) -> Dict[str, Any]:
     """Parse model reply whether it's fenced or twice-encoded."""
     txt = raw.strip()
-    if txt.startswith("```"):
-        txt = re.sub(r"^```[a-z]*\n?", "", txt, 1, flags=re.I).rstrip("`").strip()
     try:
-        return json.loads(txt)
-    except json.JSONDecodeError:
-        pass
+        doc = _json_loads(txt)                       # common case: bare JSON
+    except ValueError:
+        txt = _FENCE_RE.sub("", txt, 1).rstrip("`").strip()
+        try:
+            doc = _json_loads(txt)
+        except ValueError as e:
+            raise ValueError(f"Could not parse JSON: {e}")
+    if isinstance(doc, str):                         # twice-encoded
+        try:
+            doc = _json_loads(doc)
+        except ValueError as e:
+            raise ValueError(f"Could not parse JSON: {e}")
+    return doc
+
+def read_capped(file, limit: int):
+    """
+    Copy an (already parsed and spooled) upload out in 64 KiB chunks; None as
+    soon as it exceeds `limit`, so an oversized part is never turned into bytes.
+    """
+    buf = bytearray()
+    while chunk := file.stream.read(1 << 16):
+        buf.extend(chunk)
+        if len(buf) > limit:
+            return None
+    return bytes(buf)
+
+def json_response(doc: Dict[str, Any]):
+    """jsonify() replacement that serializes with orjson when available."""
+    if orjson is not None:
+        try:
+            return app.response_class(orjson.dumps(doc), mimetype="application/json")
+        except orjson.JSONEncodeError:
+            pass                                     # e.g. ints beyond 64 bits
+    return jsonify(doc)
+
+_BOX_KEYS = ("x1", "y1", "x2", "y2")
+
+def _as_float(v: Any) -> float:
     try:
-        inner = json.loads(txt)  # becomes str
-        return json.loads(inner)
-    except Exception as e:
-        raise ValueError(f"Could not parse JSON: {e}")
+        return float(v)
+    except Exception:
+        return 0.0
 
-def clamp_int(v: Any, lo: int, hi: int) -> int:
+def _box_array(furn: List[Dict[str, Any]]) -> np.ndarray:
+    """(N,4) float64 x1,y1,x2,y2; unparsable or non-finite values become 0."""
+    rows = [[it.get(k, 0) for k in _BOX_KEYS] for it in furn]
     try:
-        iv = int(round(float(v)))
-    except Exception:
-        iv = lo
-    return max(lo, min(hi, iv))
+        arr = np.array(rows, dtype=np.float64)
+    except (TypeError, ValueError):
+        arr = np.array([[_as_float(v) for v in r] for r in rows], dtype=np.float64)
+    arr = arr.reshape(-1, 4)
+    arr[~np.isfinite(arr)] = 0.0
+    return arr
 
 def normalize_furniture_boxes(doc: Dict[str, Any]) -> None:
     """Clamp/order furniture boxes to image bounds; drop invalids."""
     W = int(doc.get("Width", 0) or 0)
     H = int(doc.get("Height", 0) or 0)
     furn = doc.get("furniture", [])
+    if not furn:
+        doc["furniture"] = []
+        return
+
+    box = np.rint(_box_array(furn))
+    xs = np.sort(np.clip(box[:, 0::2], 0, max(0, W - 1)), axis=1)
+    ys = np.sort(np.clip(box[:, 1::2], 0, max(0, H - 1)), axis=1)
+    keep = np.flatnonzero((xs[:, 1] > xs[:, 0]) & (ys[:, 1] > ys[:, 0]))
+    coords = np.stack([xs[:, 0], ys[:, 0], xs[:, 1], ys[:, 1]], axis=1)[keep]
+
     out: List[Dict[str, Any]] = []
-    for it in furn:
-        x1 = clamp_int(it.get("x1", 0), 0, max(0, W - 1))
-        y1 = clamp_int(it.get("y1", 0), 0, max(0, H - 1))
-        x2 = clamp_int(it.get("x2", 0), 0, max(0, W - 1))
-        y2 = clamp_int(it.get("y2", 0), 0, max(0, H - 1))
-        if x2 <= x1 or y2 <= y1:
-            x1, x2 = min(x1, x2), max(x1, x2)
-            y1, y2 = min(y1, y2), max(y1, y2)
-        if x2 <= x1 or y2 <= y1:
-            continue
+    for i, (x1, y1, x2, y2) in zip(keep.tolist(), coords.astype(np.int64).tolist()):
+        it = furn[i]
         out.append({
             "x1": x1, "y1": y1, "x2": x2, "y2": y2,
             "type": str(it.get("type", "unknown")).lower(),
@@ -182,19 +265,11 @@ def merge_with_baseline(raw_json: str, furniture: List[Dict[str, Any]], dims: Tu
     enriched.setdefault("classes", orig.get("classes", []))
     enriched.setdefault("averageDoor", orig.get("averageDoor", 0))
 
-    # Fill defaults: room=unknown, confidence present
-    fixed_furn = []
-    for f in furniture:
-        fixed_furn.append({
-            "x1": int(round(float(f.get("x1", 0)))),
-            "y1": int(round(float(f.get("y1", 0)))),
-            "x2": int(round(float(f.get("x2", 0)))),
-            "y2": int(round(float(f.get("y2", 0)))),
-            "type": str(f.get("type", "unknown")).lower(),
-            "room": str(f.get("room", "unknown")).lower(),
-            "confidence": float(f.get("confidence", f.get("score", 0.0))),
-        })
-    enriched["furniture"] = fixed_furn
+    # Accept "score" as an alias; rounding/clamping/defaults happen in normalize
+    enriched["furniture"] = [
+        f if "confidence" in f else dict(f, confidence=f.get("score", 0.0))
+        for f in furniture
+    ]
     normalize_furniture_boxes(enriched)
     enriched.setdefault("schema_version", "furnish.v1")
     return enriched
@@ -202,6 +277,9 @@ def merge_with_baseline(raw_json: str, furniture: List[Dict[str, Any]], dims: Tu
 # ───────────────────────────────────────────────────────────────────
 #  GPT call
 # ───────────────────────────────────────────────────────────────────
+# static part of every request, built once and shared read-only
+_PROMPT_PART = {"type": "input_text", "text": PROMPT}
+
 def call_gpt_vision(image_b64: str, raw_json: str, mime: str) -> Dict[str, Any]:
     """Call GPT (Responses API) with image + JSON context."""
     rsp = oa_client.responses.create(
@@ -209,7 +287,7 @@ def call_gpt_vision(image_b64: str, raw_json: str, mime: str) -> Dict[str, Any]:
         input=[{
             "role": "user",
             "content": [
-                {"type": "input_text",  "text": PROMPT},
+                _PROMPT_PART,
                 {"type": "input_text",  "text": raw_json},
                 {"type": "input_image", "image_url": f"data:{mime};base64,{image_b64}"},
             ],
@@ -226,6 +304,7 @@ def call_gpt_vision(image_b64: str, raw_json: str, mime: str) -> Dict[str, Any]:
 _ultra_ok = True
 try:
     from ultralytics import YOLO
+    import torch
 except Exception:
     _ultra_ok = False
     YOLO = None  # type: ignore
@@ -235,6 +314,10 @@ YOLO_OBB_MODEL = os.getenv("YOLO_MODEL_OBB", "yolov8n-obb.pt")
 _det_model = None
 _obb_model = None
 
+# fp16 on GPU halves weight/activation traffic; CPU stays fp32
+_yolo_cuda = _ultra_ok and torch.cuda.is_available()
+YOLO_RUNTIME = {"device": 0, "half": True} if _yolo_cuda else {"device": "cpu"}
+
 # label normalization / filtering
 FURNITURE_WHITELIST = {
     "bed", "sofa", "couch", "armchair", "chair", "dining table", "table", "tv",
@@ -251,17 +334,32 @@ SYNONYM_MAP = {
     "tvmonitor": "tv",
 }
 
+_ALLOWED = frozenset(FURNITURE_WHITELIST | SYNONYM_MAP.keys())
+
 def _normalize_label(raw: str) -> str:
-    lab = (raw or "").strip().lower()
+    lab = raw.strip().lower() if raw else ""
     return SYNONYM_MAP.get(lab, lab)
 
 def _is_furniture(label: str) -> bool:
-    lab = label.lower()
-    return (lab in FURNITURE_WHITELIST) or (lab in SYNONYM_MAP)
-
-def _xyxy_of_polygon(poly8: np.ndarray):
-    xs = poly8[0::2]; ys = poly8[1::2]
-    return float(xs.min()), float(ys.min()), float(xs.max()), float(ys.max())
+    return label in _ALLOWED
+
+def _label_table(names: Dict[int, str]) -> Tuple[List[str], np.ndarray]:
+    """Normalized label and furniture flag per class id, built once per result."""
+    size = max(names, default=-1) + 1
+    labels = [_normalize_label(names.get(i, f"class_{i}")) for i in range(size)]
+    keep = np.fromiter((_is_furniture(lab) for lab in labels), dtype=bool, count=size)
+    return labels, keep
+
+def _furniture_dicts(xyxy: np.ndarray, cls: np.ndarray, conf: np.ndarray,
+                     labels: List[str], keep: np.ndarray) -> List[Dict[str, Any]]:
+    ids = cls.astype(np.int64)
+    ok = (ids >= 0) & (ids < keep.size)
+    ok[ok] = keep[ids[ok]]
+    sel = np.flatnonzero(ok)
+    return [
+        {"x1": x1, "y1": y1, "x2": x2, "y2": y2, "type": labels[c], "confidence": s}
+        for (x1, y1, x2, y2), c, s in zip(xyxy[sel].tolist(), ids[sel].tolist(), conf[sel].tolist())
+    ]
 
 def _get_yolo_model(mode: str):
     if not _ultra_ok:
@@ -269,67 +367,71 @@ def _get_yolo_model(mode: str):
     global _det_model, _obb_model
     if mode == "obb":
         if _obb_model is None:
-            _obb_model = YOLO(YOLO_OBB_MODEL)
+            _obb_model = _load_yolo(YOLO_OBB_MODEL)
         return _obb_model
     else:
         if _det_model is None:
-            _det_model = YOLO(YOLO_DET_MODEL)
+            _det_model = _load_yolo(YOLO_DET_MODEL)
         return _det_model
 
+def _load_yolo(weights: str):
+    model = YOLO(weights)
+    model.fuse()  # fold BatchNorm into the preceding convs
+    return model
+
+def warm_yolo_models() -> None:
+    """Load both models and run one dummy inference so the first request is warm."""
+    if not _ultra_ok:
+        return
+    dummy = np.zeros((640, 640, 3), np.uint8)
+    for mode in ("detect", "obb"):
+        try:
+            _get_yolo_model(mode).predict(source=dummy, verbose=False, **YOLO_RUNTIME)
+        except Exception as e:
+            print(f"YOLO {mode} warmup failed: {e}")
+
 def detect_with_yolo(np_img: np.ndarray, mode: str = "detect", conf: float = 0.25, iou: float = 0.45) -> Tuple[List[Dict[str, Any]], str]:
     """
     Returns furniture list: {x1,y1,x2,y2,type,confidence}  and mode_used.
     """
     model = _get_yolo_model("obb" if mode == "obb" else "detect")
-    results = model.predict(source=np_img, conf=conf, iou=iou, verbose=False)
+    results = model.predict(source=np_img, conf=conf, iou=iou, verbose=False, **YOLO_RUNTIME)
 
     furniture: List[Dict[str, Any]] = []
     mode_used = "obb" if mode == "obb" else "detect"
 
     for r in results:
-        names = r.names
+        labels, keep = _label_table(r.names)
 
         # Try OBB first if requested and supported
         used_obb = False
         if mode_used == "obb" and getattr(r, "obb", None) is not None:
             obb = r.obb
             try:
-                polys = obb.xyxyxyxy.cpu().numpy()
-                cls   = obb.cls.cpu().numpy()
-                confs = obb.conf.cpu().numpy()
+                # one D2H copy: [x1 y1 .. x4 y4 | cls | conf] per box
+                n = len(obb)
+                host = torch.cat([obb.xyxyxyxy.reshape(n, 8), obb.cls.reshape(n, 1),
+                                  obb.conf.reshape(n, 1)], dim=1).cpu().numpy()
+                polys, cls, confs = host[:, :8], host[:, 8], host[:, 9]
                 used_obb = True
             except Exception:
                 used_obb = False
 
             if used_obb:
-                for poly8, c, s in zip(polys, cls, confs):
-                    label_raw = names.get(int(c), f"class_{int(c)}")
-                    label = _normalize_label(label_raw)
-                    if not _is_furniture(label): continue
-                    x1, y1, x2, y2 = _xyxy_of_polygon(poly8)
-                    furniture.append({
-                        "x1": x1, "y1": y1, "x2": x2, "y2": y2,
-                        "type": label, "confidence": float(s),
-                    })
+                xs, ys = polys[:, 0::2], polys[:, 1::2]
+                xyxy = np.stack([xs.min(1), ys.min(1), xs.max(1), ys.max(1)], axis=1)
+                furniture.extend(_furniture_dicts(xyxy, cls, confs, labels, keep))
 
         # Fallback / standard boxes
         boxes = getattr(r, "boxes", None)
         if boxes is not None:
             try:
-                xyxy = boxes.xyxy.cpu().numpy()
-                cls  = boxes.cls.cpu().numpy()
-                conf = boxes.conf.cpu().numpy()
+                # boxes.data is already [x1 y1 x2 y2 (track id) conf cls]: one copy
+                data = boxes.data.cpu().numpy()
+                xyxy, conf, cls = data[:, :4], data[:, -2], data[:, -1]
             except Exception:
                 continue
-            for (x1, y1, x2, y2), c, s in zip(xyxy, cls, conf):
-                label_raw = names.get(int(c), f"class_{int(c)}")
-                label = _normalize_label(label_raw)
-                if not _is_furniture(label): continue
-                furniture.append({
-                    "x1": float(x1), "y1": float(y1),
-                    "x2": float(x2), "y2": float(y2),
-                    "type": label, "confidence": float(s),
-                })
+            furniture.extend(_furniture_dicts(xyxy, cls, conf, labels, keep))
 
     return furniture, mode_used
 
@@ -342,6 +444,11 @@ def health():
 
 @app.route("/furnish", methods=["POST"])
 def furnish_gpt():
+    # chunked bodies carry no length to check against the cap: refuse them
+    if request.content_length is None:
+        return jsonify(error="Content-Length required"), 411
+    if request.content_length > FURNISH_MAX_CONTENT_LENGTH:
+        return jsonify(error=f"Request too large (>{FURNISH_MAX_CONTENT_LENGTH} bytes)"), 413
     if "image" not in request.files or "json" not in request.form:
         return jsonify(error="Need 'image' file and 'json' text field"), 400
 
@@ -350,13 +457,20 @@ def furnish_gpt():
     if mime not in ("image/png", "image/jpeg", "image/jpg"):
         return jsonify(error="Unsupported image type (use PNG or JPEG)"), 400
 
-    img_bytes = file.read()
-    if len(img_bytes) > 4_000_000:
+    img_bytes = read_capped(file, GPT_IMAGE_LIMIT)
+    if img_bytes is None:
         return jsonify(error="Image too large (>4 MB)"), 400
-    img_b64 = base64.b64encode(img_bytes).decode()
 
+    img_b64 = binascii.b2a_base64(img_bytes, newline=False).decode("ascii")
     raw_json = request.form["json"]
 
+    # dims come from the header only; the pixels are never decoded here
+    try:
+        with Image.open(io.BytesIO(img_bytes)) as im:
+            dims = im.size
+    except Exception:
+        dims = (0, 0)
+
     # 1) Call GPT
     try:
         enriched = call_gpt_vision(img_b64, raw_json, mime)
@@ -364,17 +478,11 @@ def furnish_gpt():
         return jsonify(error=str(e)), 500
 
     # 2) Ensure baseline keys + clamp
-    try:
-        im = Image.open(io.BytesIO(img_bytes)).convert("RGB")
-        dims = (im.width, im.height)
-    except Exception:
-        dims = (0, 0)
-
     if "furniture" not in enriched or not isinstance(enriched["furniture"], list):
         enriched["furniture"] = []
 
     enriched = merge_with_baseline(raw_json, enriched["furniture"], dims)
-    return jsonify(enriched)
+    return json_response(enriched)
 
 @app.route("/furnish/yolo", methods=["POST"])
 def furnish_yolo():
@@ -395,11 +503,16 @@ def furnish_yolo():
     img_bytes = request.files["image"].read()
     raw_json  = request.form["json"]
 
-    # load image -> numpy
+    # decode straight to a BGR ndarray (what Ultralytics expects for arrays);
+    # EXIF orientation is ignored, as PIL and the header dims on /furnish do
     try:
-        im = Image.open(io.BytesIO(img_bytes)).convert("RGB")
-        np_img = np.array(im)
-        dims = (im.width, im.height)
+        np_img = cv2.imdecode(np.frombuffer(img_bytes, np.uint8),
+                              cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+        if np_img is None:
+            # formats OpenCV wasn't built with: decode with PIL as before
+            with Image.open(io.BytesIO(img_bytes)) as im:
+                np_img = cv2.cvtColor(np.asarray(im.convert("RGB")), cv2.COLOR_RGB2BGR)
+        dims = (np_img.shape[1], np_img.shape[0])
     except Exception as e:
         return jsonify(error=f"Bad image: {e}"), 400
 
@@ -411,7 +524,8 @@ def furnish_yolo():
 
     # detect
     try:
-        furniture, mode_used = detect_with_yolo(np_img_pre, mode=mode, conf=conf, iou=iou)
+        with _yolo_lock:
+            furniture, mode_used = detect_with_yolo(np_img_pre, mode=mode, conf=conf, iou=iou)
         print(furniture)
     except Exception as e:
         return jsonify(error=f"YOLO error: {e}"), 500
@@ -422,7 +536,9 @@ def furnish_yolo():
     enriched = merge_with_baseline(raw_json, furniture, dims)
     enriched["yolo_mode"] = mode_used
     enriched["prep"] = prep
-    return jsonify(enriched)
+    return json_response(enriched)
 # ───────────────────────────────────────────────────────────────────
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5200, debug=False)
+    if os.getenv("YOLO_WARMUP", "1") == "1":
+        warm_yolo_models()
+    app.run(host="0.0.0.0", port=5200, debug=False, threaded=True)
@@ -1,7 +1,28 @@
-# pip install ultralytics opencv-python
-import os, sys, json
+# pip install ultralytics opencv-python   (optional: orjson, PyTurboJPEG)
+import os, sys, json, shutil, ast
+from importlib.util import find_spec
+# grow cached CUDA blocks in place instead of fragmenting (read on first CUDA use)
+os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True")
+import numpy as np
 import torch, cv2
+from PIL import Image
 from ultralytics import YOLO
+from ultralytics.engine.results import Results
+try:
+    from ultralytics.utils.nms import non_max_suppression
+except ImportError:                     # older ultralytics
+    from ultralytics.utils.ops import non_max_suppression
+
+try:
+    import orjson                       # C JSON serializer, if installed
+except ImportError:
+    orjson = None
+
+try:
+    from turbojpeg import TurboJPEG, TJPF_BGR   # libjpeg-turbo SIMD encoder, if installed
+    _tj = TurboJPEG()                           # one native handle, reused
+except Exception:                               # module or libturbojpeg missing
+    _tj = None
 
 IMG_PATH = "/home/sejain/repos/FloorPlanTo3D-API/test.png"
 # Put your trained weights here; fallback to a public one for smoke test
@@ -15,68 +36,572 @@ CONF = 0.15       # a bit lower for line-drawings
 IOU  = 0.5
 IMGSZ = 1280
 DEVICE = 0 if torch.cuda.is_available() else "cpu"
-OUT_IMG = os.path.splitext(IMG_PATH)[0] + "_detections.jpg"
+# FP16 doubles Tensor-Core throughput and halves activation traffic; slower on CPU
+RUNTIME = {"device": DEVICE, "half": True} if DEVICE != "cpu" else {"device": DEVICE}
+# Floor plans per forward pass, and the static batch engines/ONNX are built at:
+# a larger one pads every short batch, so raise it only for bulk runs
+MAX_BATCH = int(os.getenv("YOLO_BATCH", "1"))
+# On GPU, run a TensorRT FP16 engine built once and cached next to the weights
+USE_TRT = DEVICE != "cpu" and os.getenv("YOLO_TRT", "1") == "1"
+# Opt-in INT8 engine, calibrated on (and validated against) a floor-plan dataset
+USE_INT8 = USE_TRT and os.getenv("YOLO_INT8") == "1"
+INT8_DATA = os.getenv("YOLO_INT8_DATA", "floorplans.yaml")
+INT8_MAX_MAP_DROP = float(os.getenv("YOLO_INT8_MAX_MAP_DROP", "0.01"))  # mAP50-95, absolute
+# Opt-in OpenVINO INT8 model on CPU (NNCF post-training quantization on INT8_DATA),
+# used only if it stays within INT8_MAX_MAP_DROP of the .pt model on that data
+USE_OPENVINO = DEVICE == "cpu" and os.getenv("YOLO_OPENVINO") == "1" and \
+               find_spec("openvino") is not None
+# Opt-in ONNX Runtime model (CUDA EP, IOBinding): no TensorRT build, lighter than eager
+USE_ORT = os.getenv("YOLO_ORT") == "1" and find_spec("onnxruntime") is not None
+# CPU threads for torch + OpenCV; default: physical cores (they'd oversubscribe otherwise)
+CPU_THREADS = int(os.getenv("YOLO_THREADS", "0"))
+INTEROP_THREADS = int(os.getenv("YOLO_INTEROP_THREADS", "1"))
+# Letterbox on the GPU: upload uint8 pixels, resize/pad with CUDA kernels. Only
+# used when the batch skips the predictor, which would copy a tensor source
+# back to host and rebuild it per frame
+GPU_PREPROCESS = DEVICE != "cpu" and os.getenv("YOLO_GPU_PREPROCESS", "1") == "1"
+# Call the predictor's backend (any format) + NMS directly instead of its pipeline
+RAW_FORWARD = GPU_PREPROCESS and os.getenv("YOLO_RAW_FORWARD", "1") == "1"
+MAX_DET = 300
+# Rendering + JPEG-encoding the annotated image often costs more than inference
+SAVE_ANNOT = os.getenv("SAVE_ANNOT") == "1"
+
+IMG_EXTS = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff", ".webp")
+
+def out_img(path):
+    return os.path.splitext(path)[0] + "_detections.jpg"
+
+# H2D uploads run here so image i+1 copies while image i is resized
+_copy_stream = torch.cuda.Stream() if GPU_PREPROCESS else None
+
+def _upload(imgs, device):
+    """
+    Yield each image as a raw HWC uint8 tensor on `device`. On CUDA the pixels
+    are staged in pinned memory and copied asynchronously on _copy_stream; the
+    current stream waits per image, so its resize overlaps the next copy.
+    """
+    if torch.device(device).type != "cuda":
+        for img in imgs:
+            yield torch.from_numpy(np.ascontiguousarray(img)).to(device)
+        return
+    compute = torch.cuda.current_stream()
+    for img in imgs:
+        host = torch.from_numpy(np.ascontiguousarray(img)).pin_memory()
+        with torch.cuda.stream(_copy_stream):
+            t = host.to(device, non_blocking=True)
+            done = torch.cuda.Event()
+            done.record()
+        compute.wait_event(done)
+        t.record_stream(compute)  # allocated on the copy stream, consumed here
+        yield t
+
+def letterbox_gpu(imgs, device=DEVICE, out=None):
+    """
+    BGR uint8 images -> [N,3,IMGSZ,IMGSZ] RGB float tensor in [0, 1] on `device`,
+    letterboxed like Ultralytics (bilinear resize, centred gray-114 padding).
+    Only the raw pixels cross the bus; returns the tensor and per-image
+    (ratio, pad_x, pad_y) for unletterbox(). Written into `out` when given
+    (rows past len(imgs) become blank frames).
+    """
+    if out is None:
+        out = torch.empty((len(imgs), 3, IMGSZ, IMGSZ), device=device)
+    device = out.device
+    batch = out.fill_(114 / 255)
+    frames = []
+    for i, t in enumerate(_upload(imgs, device)):
+        h, w = t.shape[:2]
+        ratio = min(IMGSZ / h, IMGSZ / w)
+        nh, nw = round(h * ratio), round(w * ratio)
+        top, left = round((IMGSZ - nh) / 2 - 0.1), round((IMGSZ - nw) / 2 - 0.1)
+        t = t.permute(2, 0, 1).flip(0).unsqueeze(0).float().div_(255)  # HWC BGR -> 1CHW RGB
+        if (nh, nw) != (h, w):
+            t = torch.nn.functional.interpolate(t, size=(nh, nw), mode="bilinear",
+                                                align_corners=False, antialias=False)
+        batch[i, :, top:top + nh, left:left + nw] = t[0]
+        frames.append((ratio, left, top))
+    return batch, frames
+
+def unletterbox(data, frame, shape):
+    """Map [x1 y1 x2 y2 ...] rows from letterboxed to original pixels, clipped."""
+    ratio, left, top = frame
+    data[:, [0, 2]] = ((data[:, [0, 2]] - left) / ratio).clip(0, shape[1])
+    data[:, [1, 3]] = ((data[:, [1, 3]] - top) / ratio).clip(0, shape[0])
+    return data
+
+def save_jpeg(path, im, quality=85):
+    if _tj is not None:
+        with open(path, "wb") as f:
+            f.write(_tj.encode(im, quality=quality, pixel_format=TJPF_BGR))
+    else:
+        cv2.imwrite(path, im, [cv2.IMWRITE_JPEG_QUALITY, quality, cv2.IMWRITE_JPEG_OPTIMIZE, 0])
+
+def physical_cores():
+    try:
+        import psutil  # ultralytics dependency
+        n = psutil.cpu_count(logical=False)
+    except Exception:
+        n = None
+    return max(1, n or (os.cpu_count() or 2) // 2)
+
+def pin_threads():
+    """One pool of physical-core size each for torch and OpenCV on CPU runs."""
+    n = CPU_THREADS or physical_cores()
+    os.environ.setdefault("OMP_NUM_THREADS", str(n))  # for libs loaded later
+    os.environ.setdefault("MKL_NUM_THREADS", str(n))
+    torch.set_num_threads(n)
+    try:
+        torch.set_num_interop_threads(INTEROP_THREADS)
+    except RuntimeError:
+        pass  # already fixed once any parallel work has run
+    cv2.setNumThreads(n)
+
+def dumps(doc):
+    """json.dumps(doc, indent=2), via orjson when available."""
+    if orjson is not None:
+        return orjson.dumps(doc, option=orjson.OPT_INDENT_2).decode()
+    return json.dumps(doc, indent=2)
+
+def label_table(names):
+    """Class id -> label as a flat tuple (ids missing from `names` map to str(id))."""
+    return tuple(names.get(i, str(i)) for i in range(max(names, default=-1) + 1))
+
+def _looks_like_checkpoint(path):
+    # torch.save writes a zip archive (or a pickle stream on very old torch)
+    try:
+        with open(path, "rb") as f:
+            head = f.read(4)
+    except OSError:
+        return False
+    return head == b"PK\x03\x04" or head[:1] == b"\x80"
 
 def pick_weights():
+    """(weights, model or None): keeps the probed YOLO so it isn't built twice."""
     for w in WEIGHTS_CANDIDATES:
         if not w: continue
+        if os.path.exists(w) and _looks_like_checkpoint(w):
+            return w, None  # local checkpoint: load it once, later
         try:
             # YOLO() will auto-download hub weights names like 'yolov8x.pt'
-            YOLO(w)
-            return w
+            return w, YOLO(w)
         except Exception:
             continue
-    return "yolov8x.pt"
-
-def main():
-    if not os.path.exists(IMG_PATH):
-        sys.exit(f"Image not found: {IMG_PATH}")
-    img = cv2.imread(IMG_PATH)
-    if img is None:
-        sys.exit(f"Failed to read image: {IMG_PATH}")
-
-    weights = pick_weights()
-    model = YOLO(weights)
-
-    results = model.predict(
-        source=IMG_PATH,
-        conf=CONF,
-        iou=IOU,
-        imgsz=IMGSZ,
-        device=DEVICE,
-        verbose=False
-    )
-
-    all_dets = []
-    for r in results:
-        names = r.names
-        has_boxes = getattr(r, "boxes", None) is not None and \
-                    getattr(r.boxes, "data", None) is not None and \
-                    r.boxes.data.shape[0] > 0
-
-        if not has_boxes:
-            print("No detections.")
+    return "yolov8x.pt", None
+
+def needs_build(path, *sources):
+    """True if `path` is missing or older than any existing `sources` file."""
+    if not os.path.exists(path):
+        return True
+    mtime = os.path.getmtime(path)
+    return any(os.path.exists(src) and os.path.getmtime(src) > mtime for src in sources)
+
+def engine_path(weights, precision):
+    # static input shape (MAX_BATCH, 3, IMGSZ, IMGSZ)
+    return f"{os.path.splitext(weights)[0]}.{MAX_BATCH}x{IMGSZ}.{precision}.engine"
+
+def build_engine(weights):
+    """
+    Export `weights` to a TensorRT FP16 engine unless a fresh one is cached.
+    The input shape is fixed at (MAX_BATCH, 3, IMGSZ, IMGSZ): with no dynamic
+    profile TensorRT picks one tactic per layer for exactly that shape, and
+    partial batches are padded (see FloorPlanDetector.detect_batch).
+    """
+    path = engine_path(weights, "fp16")
+    if needs_build(path, weights):
+        out = YOLO(weights).export(format="engine", half=True, imgsz=IMGSZ, device=DEVICE,
+                                   dynamic=False, batch=MAX_BATCH, workspace=4)
+        os.replace(out, path)
+    return path
+
+def openvino_path(weights):
+    # Ultralytics recognizes OpenVINO models by the *_openvino_model dir suffix
+    return f"{os.path.splitext(weights)[0]}.{IMGSZ}.b{MAX_BATCH}.int8_openvino_model"
+
+def build_openvino(weights, data=INT8_DATA):
+    """
+    OpenVINO INT8 model (VNNI dot products on Xeon/Core) calibrated on `data`,
+    exported unless a fresh one is cached. None if its mAP50-95 on `data`
+    trails `weights` by more than INT8_MAX_MAP_DROP.
+    """
+    path = openvino_path(weights)
+    if needs_build(path, weights):
+        out = YOLO(weights).export(format="openvino", int8=True, data=data, imgsz=IMGSZ,
+                                   dynamic=True, batch=MAX_BATCH)
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(os.path.normpath(out), path)
+    if not int8_within_budget(path, weights, data):
+        print("keeping the PyTorch model")
+        return None
+    return path
+
+def build_onnx(weights):
+    """
+    Export `weights` to ONNX (opset 17, FP16 on GPU) with the same static
+    (MAX_BATCH, 3, IMGSZ, IMGSZ) input as the engines, unless a fresh one is cached.
+    """
+    precision = "fp16" if "half" in RUNTIME else "fp32"
+    path = f"{os.path.splitext(weights)[0]}.{MAX_BATCH}x{IMGSZ}.{precision}.onnx"
+    if needs_build(path, weights):
+        out = YOLO(weights).export(format="onnx", opset=17, imgsz=IMGSZ, dynamic=False,
+                                   batch=MAX_BATCH, **RUNTIME)
+        os.replace(out, path)
+    return path
+
+class OrtNet:
+    """
+    ONNX Runtime session called like the torch net: [N,3,IMGSZ,IMGSZ] tensor in,
+    raw predictions out. Input and output are bound to torch-owned memory with
+    IOBinding, so frames never round-trip through numpy.
+    """
+
+    def __init__(self, path):
+        import onnxruntime as ort
+        providers = ["CPUExecutionProvider"]
+        if DEVICE != "cpu":
+            providers.insert(0, ("CUDAExecutionProvider", {"device_id": DEVICE}))
+        self.sess = ort.InferenceSession(path, providers=providers)
+        on_gpu = self.sess.get_providers()[0] == "CUDAExecutionProvider"
+        self.device = torch.device("cuda", DEVICE) if on_gpu else torch.device("cpu")
+        inp, outp = self.sess.get_inputs()[0], self.sess.get_outputs()[0]
+        self.input_name, self.output_name = inp.name, outp.name
+        self.input_shape = tuple(inp.shape)
+        self.dtype = torch.float16 if inp.type == "tensor(float16)" else torch.float32
+        out_dtype = torch.float16 if outp.type == "tensor(float16)" else torch.float32
+        self.out = torch.empty(tuple(outp.shape), dtype=out_dtype, device=self.device)
+        self.io = self.sess.io_binding()
+        self.io.bind_output(self.output_name, self.device.type, self.device.index or 0,
+                            self._np_dtype(out_dtype), self.out.shape, self.out.data_ptr())
+        meta = self.sess.get_modelmeta().custom_metadata_map  # written by the Ultralytics exporter
+        self.names = ast.literal_eval(meta["names"]) if "names" in meta else {}
+
+    @staticmethod
+    def _np_dtype(dtype):
+        return np.float16 if dtype == torch.float16 else np.float32
+
+    def __call__(self, x):
+        x = x.to(self.device, self.dtype).contiguous()
+        if tuple(x.shape) != self.input_shape:
+            raise ValueError(f"input {tuple(x.shape)} != model shape {self.input_shape}")
+        if x.is_cuda:
+            torch.cuda.current_stream().synchronize()  # ORT reads on its own stream
+        self.io.bind_input(self.input_name, self.device.type, self.device.index or 0,
+                           self._np_dtype(self.dtype), x.shape, x.data_ptr())
+        self.sess.run_with_iobinding(self.io)
+        return self.out.float()
+
+def _val_map(engine, data):
+    metrics = YOLO(engine, task="detect").val(data=data, imgsz=IMGSZ, batch=1,
+                                              device=DEVICE, verbose=False)
+    return float(metrics.box.map)
+
+def int8_within_budget(int8, reference, data):
+    """
+    Whether `int8`'s mAP50-95 on `data` is within INT8_MAX_MAP_DROP of
+    `reference`'s. The verdict is cached beside `int8` until either model or
+    the `data` yaml changes, or `data` points elsewhere.
+    """
+    report = os.path.normpath(int8) + ".json"
+    maps = None
+    if not needs_build(report, int8, reference, data):
+        with open(report) as f:
+            maps = json.load(f)
+    if not maps or "reference" not in maps or maps.get("data") != data:
+        maps = {"int8": _val_map(int8, data), "reference": _val_map(reference, data),
+                "data": data}
+        with open(report, "w") as f:
+            json.dump(maps, f)
+    drop = maps["reference"] - maps["int8"]
+    if drop > INT8_MAX_MAP_DROP:
+        print(f"INT8 mAP drop {drop:.4f} > {INT8_MAX_MAP_DROP}")
+        return False
+    return True
+
+def build_int8_engine(weights, reference, data=INT8_DATA):
+    """
+    TensorRT INT8 engine calibrated on `data` (Ultralytics writes the calibration
+    cache beside it). Returns None if its mAP50-95 on `data` trails the
+    `reference` engine by more than INT8_MAX_MAP_DROP; the verdict is cached.
+    """
+    path = engine_path(weights, "int8")
+    if needs_build(path, weights):
+        out = YOLO(weights).export(format="engine", int8=True, data=data, imgsz=IMGSZ,
+                                   device=DEVICE, dynamic=False, batch=MAX_BATCH, workspace=4)
+        os.replace(out, path)
+    if not int8_within_budget(path, reference, data):
+        print("keeping FP16 engine")
+        return None
+    return path
+
+def select_engine(weights):
+    """Best cached TensorRT engine for `weights`: validated INT8, else FP16."""
+    fp16 = build_engine(weights)
+    if USE_INT8:
+        try:
+            return build_int8_engine(weights, fp16) or fp16
+        except Exception as e:
+            print(f"INT8 export/validation failed ({e}); using FP16 engine")
+    return fp16
+
+class FloorPlanDetector:
+    """
+    Builds the model once and warms it up, so CUDA context init and cuDNN
+    autotuning are paid per process instead of per image. The first that
+    loads wins: ONNX Runtime (YOLO_ORT=1), the TensorRT engine on GPU, the
+    OpenVINO INT8 model on CPU (YOLO_OPENVINO=1), then the .pt weights.
+    Call detect_batch(imgs) with up to MAX_BATCH BGR images (or detect(img)
+    for one).
+    """
+
+    def __init__(self, weights=None):
+        weights, model = (weights, None) if weights else pick_weights()
+        if DEVICE != "cpu":
+            # one CUDA context, created now rather than inside the first predict
+            torch.cuda.init()
+            torch.cuda.set_device(DEVICE)
+            # every input is letterboxed to IMGSZ, so the fastest kernels stay valid
+            torch.backends.cudnn.benchmark = True
+            torch.set_float32_matmul_precision("high")  # TF32 on Ampere+
+        if USE_ORT:
+            try:
+                self._init_ort(weights, model)
+                return
+            except Exception as e:
+                print(f"ONNX Runtime setup failed ({e}); falling back to {weights}")
+        build = select_engine if USE_TRT else build_openvino if USE_OPENVINO else None
+        self.model = None
+        for attempt in range(2 if build else 0):
+            path = None
+            try:
+                path = build(weights)
+                if path:
+                    self.model, weights = self._load(path), path
+                break
+            except Exception as e:
+                if not path or attempt:
+                    print(f"{path or 'export'} failed ({e}); falling back to {weights}")
+                    break
+                # cached but unloadable (TensorRT/driver upgrade, another GPU): rebuild once
+                print(f"{path} failed to load ({e}); rebuilding it")
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                elif os.path.exists(path):
+                    os.remove(path)
+        if self.model is None:
+            self.model = self._load(weights, model)
+        # TensorRT engines only take their exact build shape
+        self.static_batch = MAX_BATCH if str(weights).endswith(".engine") else None
+        if DEVICE != "cpu" and not str(weights).endswith(".engine"):
+            # .pt fallback: NHWC weights let cuDNN pick Tensor-Core friendly conv
+            # kernels (inputs follow the weights' layout). Done after the warmup
+            # because predictor setup fuses conv+bn into fresh NCHW tensors.
+            self.model.predictor.model.model.to(memory_format=torch.channels_last)
+        self.names = self.model.names
+        self.labels = label_table(self.names)  # class names are fixed per model
+        # the AutoBackend the predictor would call: fused .pt, engine or OpenVINO
+        self.net = None
+        net = self.model.predictor.model
+        if RAW_FORWARD and not getattr(net, "end2end", False):
+            self.net = net
+            # TensorRT binds the input pointer as-is: match the engine's precision
+            self.dtype = torch.float16 if getattr(net, "fp16", False) else torch.float32
+        # letterboxed batches are written in place: no per-call allocation
+        self._buf = None
+        self.letterbox = self.net is not None
+        if self.letterbox:
+            self._buf = torch.empty((self.static_batch or MAX_BATCH, 3, IMGSZ, IMGSZ),
+                                    dtype=self.dtype, device=DEVICE)
+
+    def _load(self, weights, model=None):
+        """YOLO for `weights`, warmed up with the batch detect_batch will feed it."""
+        model = model or YOLO(weights, task="detect")
+        batch = MAX_BATCH if str(weights).endswith(".engine") else 1
+        # same half/device as detect_batch: the predictor builds its backend once
+        blank = np.full((IMGSZ, IMGSZ, 3), 114, np.uint8)
+        model.predict([blank] * batch, imgsz=IMGSZ, batch=batch, verbose=False, **RUNTIME)
+        return model
+
+    def _init_ort(self, weights, model):
+        self.net = OrtNet(build_onnx(weights))
+        self.model, self.dtype = None, self.net.dtype
+        self.names = self.net.names or (model or YOLO(weights)).names
+        self.labels = label_table(self.names)
+        self.static_batch = self.net.input_shape[0]
+        # always letterbox ourselves (on the session's device): ORT takes tensors only
+        self.letterbox = True
+        self._buf = torch.empty(self.net.input_shape, dtype=self.dtype, device=self.net.device)
+        self.net(self._buf.fill_(114 / 255))  # warm-up: CUDA EP allocates its arena here
+
+    def _frames(self, n):
+        """Preallocated letterbox rows for a batch of `n` (the engine batch if static)."""
+        if self._buf is None or n > len(self._buf):
+            return None
+        return self._buf[:self.static_batch or n]
+
+    def detect(self, img, scale=1.0, annotate=SAVE_ANNOT):
+        """(detections, result) for a BGR image; boxes are in its own pixels."""
+        return self.detect_batch([img], [scale], annotate)[0]
+
+    def detect_batch(self, imgs, scales=None, annotate=SAVE_ANNOT):
+        """
+        [(detections, result), ...] for BGR images, in one forward pass.
+        `scales` (decoded / original size, see read_image) map the boxes back
+        to the original images' pixels. On the raw-forward path `result` is
+        None unless `annotate`: it is only needed for r.plot().
+        """
+        # Much larger scans: shrink once with INTER_AREA (sharper lines than the
+        # letterbox's bilinear resize); boxes are scaled back to full resolution
+        scales = list(scales or [1.0] * len(imgs))
+        for i, img in enumerate(imgs):
+            h, w = img.shape[:2]
+            if max(h, w) > 2 * IMGSZ:
+                scale = IMGSZ / max(h, w)
+                imgs[i] = cv2.resize(img, (round(w * scale), round(h * scale)),
+                                     interpolation=cv2.INTER_AREA)
+                scales[i] *= scale
+
+        if self.letterbox:
+            source, frames = letterbox_gpu(imgs, out=self._frames(len(imgs)))
+        else:
+            source, frames = imgs, [None] * len(imgs)
+        n = len(imgs)
+        if self.static_batch:
+            source = self._pad_batch(source, n)
+
+        with torch.inference_mode():
+            if self.net is not None:
+                # no stream generator, LetterBox re-check or Results per image
+                boxes = non_max_suppression(self.net(source.to(self.dtype)), CONF, IOU,
+                                            max_det=MAX_DET)
+                results = [None] * len(imgs)
+            else:
+                results = self.model.predict(
+                    source=source,
+                    conf=CONF,
+                    iou=IOU,
+                    imgsz=IMGSZ,
+                    batch=len(source),
+                    verbose=False,
+                    **RUNTIME
+                )[:n]
+                boxes = [r.boxes.data if getattr(r, "boxes", None) is not None and
+                         getattr(r.boxes, "data", None) is not None else None for r in results]
+
+        out = []
+        for img, r, data, scale, frame in zip(imgs, results, self._host_boxes(boxes),
+                                              scales, frames):
+            if frame is not None:
+                data = unletterbox(data, frame, img.shape)
+                if annotate:
+                    # result in the image's own pixels, so r.plot() draws on it
+                    r = Results(img, path=None, names=self.names,
+                                boxes=torch.from_numpy(data.astype(np.float32)))
+            out.append((self._detections(data, scale), r))
+        return out
+
+    def _pad_batch(self, source, n):
+        """Pad to the engine's fixed batch with blank frames; reject anything else."""
+        if n > self.static_batch:
+            raise ValueError(f"batch of {n} > engine batch {self.static_batch}")
+        pad = self.static_batch - len(source)
+        if isinstance(source, torch.Tensor):
+            if pad:
+                source = torch.cat([source, source.new_full((pad, 3, IMGSZ, IMGSZ), 114 / 255)])
+            if source.shape != (self.static_batch, 3, IMGSZ, IMGSZ):
+                raise ValueError(f"input {tuple(source.shape)} != engine shape "
+                                 f"{(self.static_batch, 3, IMGSZ, IMGSZ)}")
+            return source
+        return list(source) + [np.full((IMGSZ, IMGSZ, 3), 114, np.uint8)] * pad
+
+    @staticmethod
+    def _host_boxes(boxes):
+        """
+        Per-image [x1 y1 x2 y2 (track id) conf cls] arrays from a single D2H
+        copy for the whole batch (NMS already ran on the device).
+        """
+        datas = [None if b is None else b.detach() for b in boxes]
+        counts = [0 if d is None else d.shape[0] for d in datas]
+        if not any(counts):
+            return [np.zeros((0, 6)) for _ in boxes]
+        dev = torch.cat([d for d in datas if d is not None and d.shape[0]])
+        host = dev.to("cpu", non_blocking=True)
+        if dev.is_cuda:
+            torch.cuda.current_stream().synchronize()  # async copy must land first
+        return np.split(host.numpy().astype(np.float64), np.cumsum(counts)[:-1])
+
+    def _detections(self, data, scale):
+        xyxy  = (data[:, :4] / scale).round(2).tolist()
+        confs = data[:, -2].round(4).tolist()
+        clses = data[:, -1].astype(int).tolist()
+        labels, n = self.labels, len(self.labels)
+        return [
+            {"label": labels[c] if c < n else str(c), "confidence": cf, "bbox_xyxy": xy}
+            for xy, cf, c in zip(xyxy, confs, clses)
+        ]
+
+def image_paths(args):
+    """Expand CLI args (files or directories) into image paths."""
+    for a in args:
+        if os.path.isdir(a):
+            for name in sorted(os.listdir(a)):
+                if name.lower().endswith(IMG_EXTS) and not name.endswith("_detections.jpg"):
+                    yield os.path.join(a, name)
+        elif os.path.exists(a):
+            yield a
+        else:
+            sys.exit(f"Image not found: {a}")
+
+def read_image(path):
+    """
+    (BGR image, scale) for `path`. Scans at 2x/4x IMGSZ and up are decoded
+    at 1/2 or 1/4 size straight out of the codec, since the letterbox would
+    throw those pixels away anyway; `scale` is decoded / original size.
+    """
+    try:
+        with Image.open(path) as im:  # header only
+            side = max(im.size)
+    except Exception:
+        side = 0
+    if side >= 4 * IMGSZ:
+        return cv2.imread(path, cv2.IMREAD_REDUCED_COLOR_4), 0.25
+    if side >= 2 * IMGSZ:
+        return cv2.imread(path, cv2.IMREAD_REDUCED_COLOR_2), 0.5
+    return cv2.imread(path), 1.0
+
+def image_batches(args):
+    """Decoded (path, img, scale) lists of up to MAX_BATCH images each."""
+    batch = []
+    for path in image_paths(args):
+        img, scale = read_image(path)
+        if img is None:
+            print(f"Failed to read image: {path}")
             continue
+        batch.append((path, img, scale))
+        if len(batch) == MAX_BATCH:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def main(args=None):
+    # usage: python yolo.py [image-or-dir ...]   (default: IMG_PATH)
+    args = args if args is not None else (sys.argv[1:] or [IMG_PATH])
+    if DEVICE == "cpu":
+        pin_threads()
+    detector = None
+    for batch in image_batches(args):
+        detector = detector or FloorPlanDetector()
+        paths, imgs, scales = zip(*batch)
+
+        for path, (dets, r) in zip(paths, detector.detect_batch(list(imgs), scales)):
+            if not dets:
+                print("No detections.")
+            for det in dets:
+                print(f"{det['label']} {det['confidence']:.2f} {det['bbox_xyxy']}")
 
-        for b in r.boxes:
-            cls_id = int(b.cls.item())
-            conf = float(b.conf.item())
-            x1, y1, x2, y2 = map(float, b.xyxy[0].tolist())
-            det = {
-                "label": names.get(cls_id, str(cls_id)),
-                "confidence": round(conf, 4),
-                "bbox_xyxy": [round(x1, 2), round(y1, 2), round(x2, 2), round(y2, 2)]
-            }
-            all_dets.append(det)
-            print(f"{det['label']} {det['confidence']:.2f} {det['bbox_xyxy']}")
-
-        # Save annotated image only when there are boxes
-        im = r.plot()
-        cv2.imwrite(OUT_IMG, im)
-
-    print("\nJSON:", json.dumps({"image": IMG_PATH, "detections": all_dets}, indent=2))
-    if all_dets:
-        print(f"Annotated image saved → {OUT_IMG}")
+            print("\nJSON:", dumps({"image": path, "detections": dets}))
+            # Save annotated image only when asked and there are boxes
+            if SAVE_ANNOT and dets:
+                save_jpeg(out_img(path), r.plot())
+                print(f"Annotated image saved → {out_img(path)}")
 
 if __name__ == "__main__":
     main()